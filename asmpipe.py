@@ -17,16 +17,30 @@ The script takes as input short-read FASTQ files and:
 
 #import modules
 import os, sys, re
+import shlex
 import logging, time
 import glob
 import csv
 import shutil
 from shutil import copyfile
 import datetime
+from functools import reduce
+from types import SimpleNamespace
 from argparse import ArgumentParser
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from subprocess import call
+from subprocess import call, check_output, CalledProcessError, DEVNULL, STDOUT
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#Filename patterns
+ILLUMINA_RE = re.compile(r'_(?:L001_)?R([12])_001')
+FASTQ_RE = re.compile(r'^(?P<base>.+)_(?P<read>[12])\.fastq\.gz$')
+ASM_RE = re.compile(r'_assembly(\.fasta)?$')
+VAL_RE = re.compile(r'_[12]_val_[12]$')
+
+#Sample states that remove a sample from downstream analysis
+FAILED_STATES = ('trim_failed', 'asm_failed', 'cov_failed')
 
 #Defs
 def parse_args():
@@ -47,6 +61,9 @@ def parse_args():
     return parser.parse_args()
 
 
+class CommandError(Exception):
+    pass
+
 def createFolder(directory):
     try:
         if not os.path.exists(directory):
@@ -54,11 +71,11 @@ def createFolder(directory):
     except OSError:
         print ('Error: Creating directory. ' +  directory)   
 
-def run_command(command, **kwargs):
-    command_str = ''.join(command)
-    #logging.info('Running shell command: {}'.format(command_str))
+def run_command(argv, **kwargs):
+    command_str = ' '.join(argv)
+    #logging.info('Running command: {}'.format(command_str))
     try:
-        exit_status = call(command_str, **kwargs)
+        exit_status = call(argv, **kwargs)
     except OSError as e:
         message = "Command '{}' failed due to O/S error: {}".format(command_str, str(e))
         raise CommandError({"Error:": message})
@@ -66,6 +83,40 @@ def run_command(command, **kwargs):
         message = "Command '{}' failed with non-zero exit status: {}".format(command_str, exit_status)
         raise CommandError({"Error:": message})
 
+def run_pipeline(command, **kwargs):
+    """Run a command that needs shell features (pipes, redirection) with bash, failing if any part of a pipe fails.
+    Paths and sample names put into the command must be passed through shlex.quote"""
+    run_command(['/bin/bash', '-c', 'set -o pipefail ; ' + ''.join(command)], **kwargs)
+
+def available_memory_kb():
+    """Return MemAvailable from /proc/meminfo in kB, or None where /proc/meminfo does not exist (e.g. MacOS)"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def has_fastq_gz(directory):
+    with os.scandir(directory) as entries:
+        return any(entry.name.endswith('.fastq.gz') and not entry.name.startswith('.') for entry in entries)
+
+def fastq_gz_files(directory):
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.name.endswith('.fastq.gz') and not entry.name.startswith('.')]
+
+def move_glob(pattern, dst):
+    for p in Path('.').glob(pattern):
+        shutil.move(str(p), os.path.join(dst, p.name))
+
+def rename_regex(pattern, repl, glob_pattern):
+    for p in Path('.').glob(glob_pattern):
+        new_name = re.sub(pattern, repl, p.name)
+        if new_name != p.name:
+            p.rename(p.with_name(new_name))
+
 def file_exists(seqlist, program, path, extention):
     re_run = []
     for seq in seqlist:
@@ -78,29 +129,93 @@ def file_exists(seqlist, program, path, extention):
         return re_run
 
 
+def calculate_read_depth(item, current_dir, threads):
+    """Map the trimmed reads of a sample back to its assembly and write average read depth and the std deviation of contig depth to QC/readDepth"""
+    fasta=(current_dir+'assembly/'+item+'_assembly/'+item+'_assembly.fasta')
+    trim_1=(current_dir+'trimmed_reads/'+item+'_1_val_1.fq.gz')
+    trim_2=(current_dir+'trimmed_reads/'+item+'_2_val_2.fq.gz')
+    indi_outfile=(current_dir+'QC/readDepth/'+item+'_contigX.tsv')
+    final_bam=(current_dir+'QC/readDepth/'+item+'.md.bam')
+    logging.info(item)
+
+    #Stream alignment straight through samtools, only the deduplicated BAM is written to disk.
+    #minimap2 builds its index in memory, so nothing is left next to the assembly
+    run_pipeline(['minimap2 -ax sr -t ',threads,' ',shlex.quote(fasta),' ',shlex.quote(trim_1),' ',shlex.quote(trim_2),' | \
+        samtools fixmate -m - - | \
+        samtools sort -@ ',threads,' -m 1G -l 0 -O bam - | \
+        samtools markdup -@ ',threads,' - ',shlex.quote(final_bam) ])
+
+    #Mean depth per contig from samtools coverage, one line per contig instead of one per position
+    coverage_tsv=(current_dir+'QC/readDepth/'+item+'_cov.tsv')
+    run_command(['samtools', 'coverage', '-o', coverage_tsv, final_bam])
+    coverage = pd.read_csv(coverage_tsv, sep='\t', usecols=['startpos','endpos','meandepth'])
+    contig_lengths = coverage['endpos'] - coverage['startpos'] + 1
+    mean_depth = np.average(coverage['meandepth'], weights=contig_lengths)
+    #Spread of the contig mean depths, not the per-position std deviation the older *_X.tsv files held
+    stdev_depth = np.sqrt(np.average((coverage['meandepth'] - mean_depth)**2, weights=contig_lengths))
+    with open(indi_outfile, 'w') as f:
+        f.write("{}\t{}\t{}\n".format(item, mean_depth, stdev_depth))
+    os.remove(final_bam)
+
+
+def prefix_assembly_files(sample_dir):
+    """Prefix the files in a Unicycler output directory with the sample name, e.g. assembly.fasta -> sample_assembly.fasta"""
+    prefix = ASM_RE.sub('', sample_dir.name)
+    for f in sample_dir.iterdir():
+        if f.is_file() and not f.name.startswith(prefix):
+            f.rename(f.with_name("{}_{}".format(prefix, f.name)))
+
+
+def read_counts(files, threads):
+    """Count the reads in each FASTQ file with pyfastx. The index is saved next to the file and reused on re-runs.
+    Files pyfastx cannot read (e.g. truncated gzip) get None"""
+    import pyfastx
+    def count(f):
+        try:
+            return len(pyfastx.Fastq(f, build_index=True))
+        except Exception:
+            logging.info(f+": Could not count reads with pyfastx.")
+            return None
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        return dict(zip(files, executor.map(count, files)))
+
+
 #Check versions
+def probe_version(probe):
+    """Run a single (program, shell command) version probe. Programs that are missing or print nothing are NOT FOUND"""
+    program, command = probe
+    try:
+        version = ' '.join(check_output(command, shell=True, stderr=DEVNULL, text=True).split())
+    except CalledProcessError:
+        version = ''
+    return program, version or 'NOT FOUND'
+
 def check_versions_doc(version_output):
     """Check that the programs are installed and save the version numbers in a text file called versions.txt"""
     logging.info("Checking program versions.")
     
-    try:
-        run_command(['echo "Program\tVersion" >> versions_',version_output,'.txt'], shell=True)
-        run_command(['unicycler --version >> versions_',version_output,'.txt'], shell=True)
-        run_command(['spades.py --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['trimgalversion=$(trim_galore --version | grep version | tr -d " " | sed "s/^/trim_galore\t/g" ) ; echo $trimgalversion >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['cutadapt --version | sed "s/^/cutadapt\t/g" >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['fastqc --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['multiqc --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['mlst --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['quast.py --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['bwa 2>&1 | grep Version | sed "s/^/bwa\t/g" >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['samtools --version | grep samtools >> versions_',version_output,'.txt'], shell=True)    ##Check for empty results, skip
-        run_command(['picard 2>&1 SamFormatConverter --version | sed "s/^/picard\t/g" >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-        run_command(['kleborate --version >> versions_',version_output,'.txt'], shell=True)     ##Check for empty results, skip
-
-    except:
-        logging.exception("Could not check versions of programs.")
-        sys.exit("Could not check versions of programs. Please check that the conda env assembly is activated and that the programs are in PATH")
+    version_probes = [
+        ('unicycler', 'unicycler --version'),
+        ('spades', 'spades.py --version'),
+        ('trim_galore', 'trim_galore --version | grep version'),
+        ('cutadapt', 'cutadapt --version'),
+        ('fastqc', 'fastqc --version'),
+        ('multiqc', 'multiqc --version'),
+        ('mlst', 'mlst --version'),
+        ('quast', 'quast.py --version'),
+        ('minimap2', 'minimap2 --version'),
+        ('samtools', 'samtools --version | grep samtools'),
+        ('kleborate', 'kleborate --version'),
+        ]
+    #Probes only wait on subprocesses, so run them all at once
+    with ThreadPoolExecutor(max_workers=len(version_probes)) as executor:
+        versions = list(executor.map(probe_version, version_probes))
+    with open('versions_'+version_output+'.txt', 'w') as version_file:
+        version_file.write("Program\tVersion\n")
+        for program, version in versions:
+            if version == 'NOT FOUND':
+                logging.warning("Could not find "+program+". Please check that the conda env assembly is activated and that the program is in PATH")
+            version_file.write(program+"\t"+version+"\n")
 
 
 ##To do: In future, add versions to final assembly stats file.
@@ -146,10 +261,21 @@ def main():
         depth_filter=str(args.depth_filter)
         print('Unicycler depth filter set to: '+ str(depth_filter))
 
+    #Threads per unicycler job: unicycler's own default of min(8, cpu_count), passed to both -t and --spades_options -t
+    unic_job_threads=str(min(8, os.cpu_count() or 8))
+
+    #Optional steps of the pipeline
+    run = SimpleNamespace(
+        qc=not (args.noex or args.nofqc),
+        mlst=not (args.noex or args.nomlst),
+        quast=not (args.noex or args.noquast),
+        cov=not (args.noex or args.nocov),
+        klebs=args.klebs)
+
     if args.noex:
         print('Trimming and assembling reads only, no QC or downstream analyses.')
     if args.nofqc:
-        print('Trimming and assembling reads only, no QC or downstream analyses.')
+        print('FastQC and MultiQC will not be run.')
     if args.nomlst:
         print('MLST will not be run.')
     if args.noquast:
@@ -159,13 +285,9 @@ def main():
 
     
 
-    if not args.noex and not args.nofqc and not args.nomlst and not args.noquast and not args.nocov and not args.klebs:
-        print("Pipeline will be run with: TrimGalore, fastQC, multiQC, Unicycler, Quast, mlst and read depth calculation.")
-    if not args.noex and not args.nofqc and not args.nomlst and not args.noquast and not args.nocov and args.klebs:
-        print("Pipeline will be run with: TrimGalore, fastQC, multiQC, Unicycler, Quast, mlst, read depth calculation and kleborate.")
-    else:
-        if args.klebs:
-            print('Kleborate will be run on all samples with option --all.')
+    steps = ['TrimGalore'] + (['fastQC', 'multiQC'] if run.qc else []) + ['Unicycler'] + (['Quast'] if run.quast else []) + \
+        (['mlst'] if run.mlst else []) + (['read depth calculation'] if run.cov else []) + (['kleborate (--all)'] if run.klebs else [])
+    print("Pipeline will be run with: " + ', '.join(steps) + ".")
 
     #Set current working directory
     current_dir = os.getcwd()
@@ -175,34 +297,21 @@ def main():
     fastq_raw=(current_dir+'Fastq_raw')
     for filename in glob.glob(os.path.join(fastq_raw, '*fastq.gz')):
         shutil.move(filename, current_dir)
-    if any(File.endswith(".fastq.gz") for File in os.listdir(current_dir)):
+    if has_fastq_gz(current_dir):
         logging.info('Input files are *.fastq.gz')
         #Rename files if named *_R?_001
-        if any(File.endswith(".fastq.gz") for File in os.listdir(current_dir)):
-            run_command(["rename 's/_L001_R1_001/_1/g' ",current_dir,"*R1* && rename 's/_L001_R2_001/_2/g' ",current_dir,"*R2*"], shell=True)
-            run_command(["rename 's/_R1_001/_1/g' ",current_dir,"*R1* && rename 's/_R2_001/_2/g' ",current_dir,"*R2*"], shell=True)
+        rename_regex(ILLUMINA_RE, r'_\1', '*R[12]*')
         #Add all sequences to sequence_list
-        sequences = glob.glob("*fastq.gz")  #Only works for .fastq.gz suffix currently
-        sequence_list = []
+        sequences = fastq_gz_files(current_dir)  #Only works for .fastq.gz suffix currently
+        observed_reads = {}
         for sequence in sequences:
-            name = sequence.replace(".gz","")
-            if name.find('_1.fastq') != -1 and name[:-8] not in sequence_list:
-                sequence_list.append(name[:-8])
-            if name.find('_2.fastq') != -1 and name[:-8] not in sequence_list:
-                sequence_list.append(name[:-8])  
+            match = FASTQ_RE.match(sequence)
+            if match:
+                observed_reads.setdefault(match['base'], set()).add(match['read'])
+        sequence_list = list(observed_reads)
 
         #Check that all reads have pairs
-        missing_pairs = []
-        for seqName in sequence_list:
-            sequence_1 = False
-            sequence_2 = False
-            for sequence in sequences:
-                if sequence.find(seqName+'_1.f') != -1:
-                    sequence_1 = True
-                if sequence.find(seqName+'_2.f') != -1:
-                    sequence_2 = True
-            if sequence_1 == False or sequence_2 == False:
-                missing_pairs.append(seqName)
+        missing_pairs = [seqName for seqName, reads in observed_reads.items() if reads != {'1', '2'}]
 
         if missing_pairs != []:
             logging.info("\nNot all sequence sets have pairs:")
@@ -218,13 +327,11 @@ def main():
         
         createFolder(current_dir+'logs/') 
         #broken_files = createFolder(current_dir+'broken_files/')
-        unsuccessful_sequences=[]
+        status = {seq: 'ok' for seq in sequence_list}
 
         createFolder(current_dir+'trimmed_reads') 
-        try:
-            run_command(['mv *val*gz *unpaired*gz ./trimmed_reads  2>/dev/null'], shell=True)
-        except:
-            pass
+        move_glob('*val*gz', current_dir+'trimmed_reads')
+        move_glob('*unpaired*gz', current_dir+'trimmed_reads')
 
         #Trimming
         run_list = []
@@ -245,20 +352,29 @@ def main():
                 for item in uniq_run_list:
                     w.write("%s\n" % item)
             try:
-                run_command(["parallel --jobs ",threads," 'echo {} ; trim_galore --paired {}_1.fastq.gz {}_2.fastq.gz >> ./logs/{}_trimgalore.log 2>&1' ::: $(cat ",current_dir,"uniq_trimgalore_list.txt) ; cd ",current_dir ], shell=True)
-                logging.info(item+": TrimGalore success.")
-                run_command(['mv *val* ./trimmed_reads 2>/dev/null'], shell=True)
+                trim_job = "trim_galore --paired {}_1.fastq.gz {}_2.fastq.gz >> ./logs/{}_trimgalore.log 2>&1"
+                if run.qc:
+                    #FastQC each sample as soon as it is trimmed. Failed FastQC runs are picked up again by the FastQC step below
+                    createFolder(current_dir+'QC/fastQC')
+                    trim_job += " && mv {}_?_val_?.fq.gz ./trimmed_reads/ && { fastqc ./trimmed_reads/{}_1_val_1.fq.gz ./trimmed_reads/{}_2_val_2.fq.gz -o QC/fastQC >> ./logs/{}_fastqc_trimmed.log 2>&1 || true ; }"
+                run_command(['parallel', '--jobs', threads, '-a', current_dir+'uniq_trimgalore_list.txt', 'echo {} ; '+trim_job])
+                logging.info("TrimGalore success.")
+                move_glob('*val*', current_dir+'trimmed_reads')
                 #TODO:ADD size-check:run_command(['if [ -s "" ] ; then echo "WARNING: Trimmed file is empty, please check." ; fi'], shell=True)
             except:
-                logging.info(item+": Trimming unsuccessful. Removing from downstream analysis.")
-                for file in glob.glob(item+'*_fq.gz'):
-                    os.remove(file)
-                sequence_list.remove(item)
-                unsuccessful_sequences.append(item)
+                #parallel fails if any job fails, so find the samples that have no trimmed reads
+                move_glob('*val*', current_dir+'trimmed_reads')
+                failed_list = (file_exists(uniq_run_list, 'trimgalore', './trimmed_reads/', '_1_val_1.fq.gz') or []) + (file_exists(uniq_run_list, 'trimgalore', './trimmed_reads/', '_2_val_2.fq.gz') or [])
+                for item in set(failed_list):
+                    logging.info(item+": Trimming unsuccessful. Removing from downstream analysis.")
+                    for file in glob.glob(current_dir+'trimmed_reads/'+item+'_?_val_?.fq.gz'):
+                        os.remove(file)
+                    status[item] = 'trim_failed'
+            sequence_list = [seq for seq, state in status.items() if state not in FAILED_STATES]
 
 
         #Run FastQC and multiQC
-        if not args.nofqc and not args.noex:
+        if run.qc:
             logging.info('Running FastQC')
             createFolder(current_dir+'QC/fastQC') 
             createFolder(current_dir+'QC/multiqc_trimmed') 
@@ -282,19 +398,21 @@ def main():
             #for item in run_list: 
                 try:
                     #run_command(['fastqc ',current_dir,'trimmed_reads/', item, ' -o QC/fastQC > ',current_dir,'logs/',item,'_fastqc_trimmed_',todays_date,'.log 2>&1' ], shell=True)
-                    run_command(["parallel --jobs ",threads," 'echo {} ; fastqc ./trimmed_reads/{} -o QC/fastQC >> ./logs/{}_fastqc_trimmed.log 2>&1' ::: $(cat ",current_dir,"uniq_fastqc_list.txt) ; cd ",current_dir ], shell=True)
+                    run_command(['parallel', '--jobs', threads, '-a', current_dir+'uniq_fastqc_list.txt', 'echo {} ; fastqc ./trimmed_reads/{} -o QC/fastQC >> ./logs/{}_fastqc_trimmed.log 2>&1'])
 
-                    logging.info(item+": FastQC success. ")
+                    logging.info("FastQC success. ")
                 except:
-                    logging.info(item+": FastQC unsuccessful. ")
-                    unsuccessful_sequences.append(item)
+                    failed_list = (file_exists(sequence_list, 'fastqc', './QC/fastQC/', '_1_val_1_fastqc.zip') or []) + (file_exists(sequence_list, 'fastqc', './QC/fastQC/', '_2_val_2_fastqc.zip') or [])
+                    for item in set(failed_list):
+                        logging.info(item+": FastQC unsuccessful. ")
+                        status[item] = 'fastqc_failed'
                 #ToDo: Add parallel runs of fastqc
     
             
             #Run multiqc (will run regardless of previous versions)
             logging.info('Running MultiQC.')
             try:
-                run_command(['multiqc ',current_dir,'QC/fastQC -f -o ',current_dir,'QC/multiqc_trimmed/'], shell=True)  #Add option to run only multiqc if fastqc already exists
+                run_command(['multiqc', current_dir+'QC/fastQC', '-f', '-o', current_dir+'QC/multiqc_trimmed/'])  #Add option to run only multiqc if fastqc already exists
                 logging.info("MultiQC success.")
             except:
                 logging.info("MultiQC failure.")
@@ -309,7 +427,7 @@ def main():
         for seq in sequence_list:
             if os.path.isfile(current_dir + 'success/'+seq+'_Assembly_complete.txt'):
                 logging.info(seq+": Assembly complete.")
-                run_command(["mv ",seq,"_?.fastq.gz Fastq_raw"], shell=True)
+                move_glob(seq+'_?.fastq.gz', current_dir+'Fastq_raw')
             else:
                 logging.info(seq+": Assembly incomplete.")
                 run_list.append(seq)
@@ -324,21 +442,25 @@ def main():
             with open('uniq_run_list_as.txt', 'w') as f:
                 for item in uniq_run_list:
                     f.write("%s\n" % item)
+
+            #Cap SPAdes memory so that the unicycler jobs running at the same time fit on the node together (20% memory headroom)
+            spades_options=''
+            mem_kb = available_memory_kb()
+            if mem_kb:
+                parallel_jobs = min(int(unic_threads), len(uniq_run_list))
+                spades_mem = max(1, int(mem_kb / 1024 / 1024 / parallel_jobs / 1.2))
+                spades_options = ' --spades_options "-m '+str(spades_mem)+' -t '+unic_job_threads+'"'
+                print('SPAdes limited to '+str(spades_mem)+' GB and '+unic_job_threads+' threads per unicycler job')
             try:
-                run_command(["cd ",trimmed_dir," ; parallel --jobs ",unic_threads," 'echo {} ; unicycler -1 {}_1_val_1.fq.gz -2 {}_2_val_2.fq.gz \
-                     -o ../assembly/{}_assembly --verbosity 2 --keep 2 --depth_filter ",depth_filter," ; touch ../success/{}_Assembly_complete.txt; mv ../{}_?.fastq.gz ../Fastq_raw' ::: $(cat ",current_dir,"uniq_run_list_as.txt) ; cd ",current_dir], shell=True)
+                run_command(['parallel', '--jobs', unic_threads, '-a', current_dir+'uniq_run_list_as.txt', 'echo {} ; unicycler -1 {}_1_val_1.fq.gz -2 {}_2_val_2.fq.gz \
+                     -o ../assembly/{}_assembly --verbosity 2 --keep 2 -t '+unic_job_threads+' --depth_filter '+depth_filter+spades_options+' ; touch ../success/{}_Assembly_complete.txt; mv ../{}_?.fastq.gz ../Fastq_raw'], cwd=trimmed_dir)
             except:
                 logging.info(": Assembly unsuccessful.") # Removing from downstream analysis.")
 
         try:
-            for root, dirs, files in os.walk("./assembly/"):
-                if not files:
-                    continue
-                prefix = os.path.basename(root)
-                prefix= prefix.replace('_assembly', '')
-                for f in files:
-                    if not f.startswith(prefix):
-                        os.rename(os.path.join(root, f), os.path.join(root, "{}_{}".format(prefix, f)))
+            sample_dirs = [d for d in Path(current_dir+'assembly').iterdir() if d.is_dir()]
+            with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+                list(executor.map(prefix_assembly_files, sample_dirs))
         except:
             pass
         #Copy files to fasta-directory
@@ -350,47 +472,53 @@ def main():
         except:
             pass
 
+        for seq in sequence_list:
+            if not os.path.isfile(current_dir+'fasta/'+seq+'_assembly.fasta'):
+                logging.info(seq+": No assembly found. Removing from downstream analysis.")
+                status[seq] = 'asm_failed'
+        sequence_list = [seq for seq, state in status.items() if state not in FAILED_STATES]
+
         #Move Reads to folders
         createFolder(current_dir+'QC/trimmed_reads')
-        try:
-            run_command(['mv *trimming_report.txt ./QC/trimmed_reads 2>/dev/null'], shell=True)
-        except:
-            pass
+        move_glob('*trimming_report.txt', current_dir+'QC/trimmed_reads')
        
         #Run Quast
-        if not args.noquast and not args.noex:
+        quast_report = None
+        if run.quast:
             logging.info('Running Quast on fasta')
             createFolder(current_dir+'QC/Quast')
             try:
-                run_command(['quast.py ',current_dir,'fasta/*fasta -o ',current_dir,'QC/Quast > ',current_dir,'logs/quast_',todays_date,'.log 2>&1'], shell=True)
+                with open(current_dir+'logs/quast_'+todays_date+'.log', 'w') as quast_log:
+                    run_command(['quast.py'] + sorted(glob.glob(current_dir+'fasta/*fasta')) + ['-o', current_dir+'QC/Quast'], stdout=quast_log, stderr=STDOUT)
                 logging.info("Quast successful")
                 logging.info('Remember to open the transposed_report.tsv file to assess the quality of your assembled reads - main points to look at: Total contigs (<700, GC% (should match the species), total length (should match the species), and have a general look at largest contig, N50 and L50 values.')
                 #Create Quast report
-                quast_report = pd.read_csv(current_dir+'QC/Quast/transposed_report.tsv', sep='\t')
-                for index, row in quast_report.iterrows():
-                    contigs = row[1]
-                    if contigs > 700:
-                        print("NOTE: More than 700 contigs in "+row[0]+". Resequencing adviced.")
-                    elif contigs > 400 and contigs < 700:
-                        print("NOTE: More than 400 contigs in "+row[0]+". Consider resequencing.")
+                quast_report = pd.read_csv(current_dir+'QC/Quast/transposed_report.tsv', sep='\t', usecols=['Assembly','# contigs (>= 0 bp)','GC (%)','N50','L50','Total length (>= 0 bp)','Largest contig'])
+                contigs = quast_report['# contigs (>= 0 bp)']
+                notes = ["NOTE: More than 700 contigs in "+assembly+". Resequencing adviced." for assembly in quast_report.loc[contigs > 700, 'Assembly']]
+                notes += ["NOTE: More than 400 contigs in "+assembly+". Consider resequencing." for assembly in quast_report.loc[(contigs > 400) & (contigs <= 700), 'Assembly']]
+                if notes:
+                    print('\n'.join(notes))
             except:
                 logging.info("Quast unsuccessful.")
         
         #Get species and ST
         createFolder(current_dir+'analyses')
-        if not args.nomlst and not args.noex:
+        if run.mlst:
             logging.info('Looking for MLST')
             try:
-                run_command(['cd ',current_dir,'fasta/ ; mlst *fasta > ',current_dir,'analyses/mlst.tsv ; cd ',current_dir], shell= True)
+                with open(current_dir+'analyses/mlst.tsv', 'w') as mlst_out:
+                    run_command(['mlst'] + sorted(p.name for p in Path(current_dir+'fasta').glob('*fasta')), cwd=current_dir+'fasta/', stdout=mlst_out)
                 logging.info("Species and MLST identification success")
             except:
                 logging.info("Species and MLST identification failed. Check input-directory. Alternatively, run mlst manually on the terminal in the ./fasta-directory: 'mlst *fasta >> mlst.tsv '")
 
         #Get average read depth and its std deviation
-        if not args.nocov and not args.noex:
+        if run.cov:
             run_list = []
             for seq in sequence_list:
-                if os.path.isfile(current_dir + 'success/'+seq+'_readDepth.Success'):
+                #Samples from older runs only have a per-position *_X.tsv, so they are calculated again
+                if os.path.isfile(current_dir + 'success/'+seq+'_readDepth.Success') and os.path.isfile(current_dir+'QC/readDepth/'+seq+'_contigX.tsv'):
                     logging.info(seq+": Average Read Depth has been calculated.")
                 else:
                     run_list.append(seq)
@@ -403,41 +531,36 @@ def main():
                 # with open('uniq_readDepth_list.txt', 'w') as w:
                 #     for item in uniq_run_list:
                 #         w.write("%s\n" % item)
-                for item in uniq_run_list: 
-                    logging.info(item)
-                    try:
-                        fasta=(current_dir+'assembly/'+item+'_assembly/'+item+'_assembly.fasta')
-                        trim_1=(current_dir+'trimmed_reads/'+item+'_1_val_1.fq.gz')
-                        trim_2=(current_dir+'trimmed_reads/'+item+'_2_val_2.fq.gz')
-                        indi_outfile=(current_dir+'QC/readDepth/'+item+'_X.tsv') 
-                        outfile=(current_dir+'QC/readDepth/overall_readDepth.tsv') 
-                        run_command(['bwa index ', fasta], shell= True)
-                        
-                        run_command(['bwa mem -t ',threads,' ',fasta,' ',trim_1,' ',trim_2,' > input_c.sam  ; \
-                            picard SamFormatConverter INPUT=input_c.sam VALIDATION_STRINGENCY=SILENT OUTPUT=input_c.bam ; \
-                            picard SortSam INPUT=input_c.bam OUTPUT=input_2_c.bam VALIDATION_STRINGENCY=SILENT SORT_ORDER=coordinate ; \
-                            picard MarkDuplicates INPUT=input_2_c.bam VALIDATION_STRINGENCY=SILENT OUTPUT=final_cont.bam METRICS_FILE=dup_metrics ; \
-                            picard BuildBamIndex INPUT=final_cont.bam VALIDATION_STRINGENCY=SILENT OUTPUT=final_cont.bam.bai ' ], shell= True)
-                            
-                        run_command(["echo -n '",item," \t' >> ",indi_outfile," ; tot_size=$(samtools view -H final_cont.bam | grep -P '^@SQ' | cut -f 3 -d ':' | awk '{sum+=$1} END {print sum}') ; echo $tot_size ; samtools depth final_cont.bam |awk -v var=$tot_size '{sum+=$3; sumsq+=$3*$3} END {print sum/var \"\t\" sqrt(sumsq/var - (sum/var)*2)}' >> ",indi_outfile," ; rm final_cont* dup_m* input* "  ], shell= True)
-                        logging.info(item+": Average Read Depth  calculation success.")
-                        run_command(['touch ',current_dir,'success/',item,'_readDepth.Success'], shell= True)
-
-                    except:
-                        logging.info(item+": Average Read Depth calculation unsuccessful. Removing from downstream analysis.")
-                        sequence_list.remove(item)
-                        unsuccessful_sequences.append(item)
+                #Run depth_jobs samples at a time with depth_threads threads each
+                if int(threads) > 8:
+                    depth_jobs=int(threads)//8
+                    depth_threads=str(8)
+                else:
+                    depth_jobs=1
+                    depth_threads=threads
+                with ThreadPoolExecutor(max_workers=depth_jobs) as executor:
+                    futures = {executor.submit(calculate_read_depth, item, current_dir, depth_threads): item for item in uniq_run_list}
+                    for future in as_completed(futures):
+                        item = futures[future]
+                        try:
+                            future.result()
+                            logging.info(item+": Average Read Depth  calculation success.")
+                            Path(current_dir+'success/'+item+'_readDepth.Success').touch()
+                        except:
+                            logging.info(item+": Average Read Depth calculation unsuccessful. Removing from downstream analysis.")
+                            status[item] = 'cov_failed'
+                sequence_list = [seq for seq, state in status.items() if state not in FAILED_STATES]
             outfile=(current_dir+'QC/readDepth/overall__readDepth.tsv') 
-            cov_files=(current_dir+'QC/readDepth/*_X.tsv') 
-            run_command(['cat ',cov_files,' > ',outfile], shell= True)    
+            cov_files=sorted(Path(current_dir+'QC/readDepth').glob('*_contigX.tsv'))
+            Path(outfile).write_bytes(b''.join(cov_file.read_bytes() for cov_file in cov_files))
             
         #Run kleborate
         #ToDO: integrate Kleborate and ABRICATE in final report
-        if args.klebs:
+        if run.klebs:
             logging.info("Running Kleborate on your samples")
             try:
                 koutfile=(current_dir+'analyses/Kleborate_'+todays_date+'.txt') 
-                run_command(['kleborate --all -a ',current_dir,'fasta/*fasta -o ',koutfile], shell= True) 
+                run_command(['kleborate', '--all', '-a'] + sorted(glob.glob(current_dir+'fasta/*fasta')) + ['-o', koutfile])
             except:
                 print("Kleborate failed, do you have kleborate in your path?")
                 pass
@@ -446,9 +569,9 @@ def main():
 
         logging.info("Creating lists of successful and unsuccessful sequences, see 'successful_sequences.txt' and 'failed_sequences.txt'.")
         with open("successful_sequences.txt","w") as seq_suc:
-            seq_suc.write(("\n".join([str(i) for i in sequence_list] )))
+            seq_suc.write(("\n".join([seq for seq, state in status.items() if state == 'ok'] )))
         with open("failed_sequences.txt","w") as seq_unsuc:
-            seq_unsuc.write(("\n".join([str(i) for i in unsuccessful_sequences] )))
+            seq_unsuc.write(("\n".join([seq for seq, state in status.items() if state != 'ok'] )))
         
     else:
         logging.info('ERROR: Please provide input files in fastq.gz format. If your FASTQ files are separated into one folder for each read (like when downloaded from basespace), copy and paste the following into the command line: mv */* ./ ; find . -type d -empty -delete ')
@@ -456,44 +579,60 @@ def main():
     ###Creating output-file
     seq_df = pd.DataFrame(sequence_list, columns=["Assembly"])  #Created first col with seqname for each file
     
-    #need to tweak for options
+    #Only merge the results of steps that were run and produced output
+    report_frames = []
+
     #mlst
-    mlst_file = pd.read_csv('analyses/mlst.tsv', sep='\t', header=None, names=list(['Assembly','species', 'ST', 'al1','al2','al3','al4','al5','al6','al7']))
-    mlst_df = mlst_file.replace("_assembly.fasta","", regex=True)
-    mlst_df_sub = mlst_df[['Assembly','species','ST']]
-    seq_df_mlst = pd.merge(seq_df, mlst_df_sub, on='Assembly', how='outer')
-
-    quast_file = pd.read_csv(current_dir+'QC/Quast/transposed_report.tsv', sep='\t')
-    quast_df = quast_file.replace("_assembly","", regex=True)
-    #TODO: Edit _ to - in quast
-    quast_df.rename(columns={'# contigs (>= 0 bp)':'#contigs'}, inplace=True)
-    quast_df.rename(columns={'Total length (>= 0 bp)':'Total_length'}, inplace=True)
-    quast_df_sub = quast_df[['Assembly', '#contigs','GC (%)','N50', 'L50', 'Total_length', 'Largest contig']]
-    seq_df_mlst_quast = pd.merge(seq_df_mlst, quast_df_sub, on='Assembly', how='outer')
+    mlst_tsv = current_dir+'analyses/mlst.tsv'
+    if run.mlst and os.path.isfile(mlst_tsv):
+        mlst_file = pd.read_csv(mlst_tsv, sep='\t', header=None, usecols=[0,1,2], names=['Assembly','species','ST'])
+        mlst_df = mlst_file.assign(Assembly=mlst_file['Assembly'].str.replace(ASM_RE, '', regex=True))
+        mlst_df_sub = mlst_df[['Assembly','species','ST']]
+        report_frames.append(mlst_df_sub)
+
+    #Reuse the Quast report read in the Quast step
+    if quast_report is not None:
+        quast_df = quast_report.assign(Assembly=quast_report['Assembly'].str.replace(ASM_RE, '', regex=True))
+        #TODO: Edit _ to - in quast
+        quast_df.rename(columns={'# contigs (>= 0 bp)':'#contigs'}, inplace=True)
+        quast_df.rename(columns={'Total length (>= 0 bp)':'Total_length'}, inplace=True)
+        quast_df_sub = quast_df[['Assembly', '#contigs','GC (%)','N50', 'L50', 'Total_length', 'Largest contig']]
+        report_frames.append(quast_df_sub)
 
     #AVG COV + STDEV
-    cov_file = pd.read_csv(current_dir+'QC/readDepth/overall__readDepth.tsv', sep='\t', header=None)
-    cov_file.columns = ['Assembly','Avg_readDepth','StDev']
-    cov_file = cov_file.replace(" ","", regex=True)
-    cov_df_sub = cov_file[['Assembly','Avg_readDepth','StDev']]
-    seq_df_mlst_quast_cov = pd.merge(seq_df_mlst_quast, cov_df_sub, on='Assembly', how='outer')
-
-    #fastqc_file=
-    fastqc_file = pd.read_csv(current_dir+'QC/multiqc_trimmed/multiqc_data/multiqc_fastqc.txt', sep='\t')
-    fastqc_df = fastqc_file.replace("_1_val_1","", regex=True)
-    fastqc_df = fastqc_df.replace("_2_val_2","", regex=True)
-    fastqc_df.rename(columns={'Sample':'Assembly'}, inplace=True)
-    fastqc_df.rename(columns={'Total Sequences':'#Reads'}, inplace=True)
-    fastqc_df_sub = fastqc_df[['Assembly', '#Reads']]
-    fastqc_df_sub=fastqc_df_sub.drop_duplicates() #All pairs should have same number of reads/sequences
-    seq_df_mlst_quast_cov_fastqc = pd.merge(seq_df_mlst_quast_cov, fastqc_df_sub, on='Assembly', how='outer')
-    
-    seq_df_mlst_quast_cov_fastqc.to_csv(path_or_buf='Asmbl_'+todays_date+'.csv', sep="\t")
+    cov_tsv = current_dir+'QC/readDepth/overall__readDepth.tsv'
+    if run.cov and os.path.isfile(cov_tsv) and os.path.getsize(cov_tsv) > 0:
+        cov_file = pd.read_csv(cov_tsv, sep='\t', header=None)
+        cov_file.columns = ['Assembly','Avg_readDepth','StDev_contig_depth']
+        cov_file['Assembly'] = cov_file['Assembly'].str.strip()
+        cov_df_sub = cov_file[['Assembly','Avg_readDepth','StDev_contig_depth']]
+        report_frames.append(cov_df_sub)
+
+    #Number of reads, counted on the trimmed R1 files (both reads of a pair have the same number of reads)
+    try:
+        trimmed_r1 = [current_dir+'trimmed_reads/'+seq+'_1_val_1.fq.gz' for seq in sequence_list]
+        counts = read_counts([f for f in trimmed_r1 if os.path.exists(f)], threads)
+        fastqc_df_sub = pd.DataFrame({'Assembly': sequence_list, '#Reads': [counts.get(f) for f in trimmed_r1]})
+        report_frames.append(fastqc_df_sub)
+    except ImportError:
+        multiqc_txt = current_dir+'QC/multiqc_trimmed/multiqc_data/multiqc_fastqc.txt'
+        if os.path.isfile(multiqc_txt):
+            logging.info("pyfastx not found, reading number of reads from MultiQC.")
+            fastqc_file = pd.read_csv(multiqc_txt, sep='\t', usecols=['Sample','Total Sequences'])
+            fastqc_df = fastqc_file.assign(Sample=fastqc_file['Sample'].str.replace(VAL_RE, '', regex=True))
+            fastqc_df.rename(columns={'Sample':'Assembly'}, inplace=True)
+            fastqc_df.rename(columns={'Total Sequences':'#Reads'}, inplace=True)
+            fastqc_df_sub = fastqc_df[['Assembly', '#Reads']]
+            fastqc_df_sub=fastqc_df_sub.drop_duplicates() #All pairs should have same number of reads/sequences
+            report_frames.append(fastqc_df_sub)
+        else:
+            logging.info("pyfastx not found and no MultiQC report, number of reads is left out of the report.")
 
-    try:   
-            run_command(['mv *fastq.gz ./Fastq_raw 2>/dev/null'], shell=True)
-    except:
-        pass
+    #Merge all results onto the sequence list
+    report_df = reduce(lambda left, right: left.merge(right, on='Assembly', how='outer'), report_frames, seq_df)
+    report_df.to_csv(path_or_buf='Asmbl_'+todays_date+'.csv', sep="\t")
+
+    move_glob('*fastq.gz', current_dir+'Fastq_raw')
     #End of file
     total_time = time.time() - start_time
     time_mins = float(total_time) / 60